@@ -496,6 +496,10 @@ const parseKey = function(key) {
 		sessions.set(channel.id, session);
 
 		connected.then(() => {
+			// Non-ASCII is sent as raw UTF-8, which may be split across
+			// chunks, so let the socket decode it
+			comm.setEncoding('utf8');
+
 			let buf = '';
 			comm.on('data', chunk => {
 				buf += chunk;
@@ -7,7 +7,6 @@ import enum
 import errno
 import fcntl
 import functools
-import itertools
 import json
 import os
 import pty
@@ -24,10 +23,27 @@ import uuid
 import fuse
 import pyte
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 DISCORD_UPLOAD_MOUNT = '/run/discord-upload-fuse'
 CONTAINER_RUN = '/run/container-run'
 BOT_TCP_ADDR = '0.0.0.0', 49813
 
+IDNAME_RE = re.compile(r'^[a-zA-Z0-9]{1,30}$')
+
+if orjson is not None:
+    json_dumps = orjson.dumps
+    json_loads = orjson.loads
+else:
+    def json_dumps(obj):
+        return json.dumps(
+            obj, separators=(',', ':'), ensure_ascii=False).encode()
+
+    json_loads = json.loads
+
 THIS_PID = os.getpid()
 
 fuse.fuse_python_api = (0, 2)
@@ -68,6 +84,8 @@ umount2 = libc_errno_wrapper(umount2)
 
 MNT_DETACH = 2
 
+IOV_MAX = os.sysconf('SC_IOV_MAX')
+
 
 def path_to_uuid(path):
     if not path or path[0] != '/':
@@ -107,17 +125,20 @@ class DiscordUploaderFile:
 
     def __init__(self, path, flags):
         self.uuid = path_to_uuid(path)
+        with discord_upload_callbacks_lock:
+            self.upload_cb = discord_upload_callbacks.get(self.uuid)
         self.iolock = threading.Lock()
-        self.data = b''
+        self.data = bytearray()
         self.efbig_hit = False
 
     def read(self, size, offset):
         return -errno.EPERM
 
     def write(self, buf, offset):
-        with discord_upload_callbacks_lock:
-            if self.uuid not in discord_upload_callbacks:
-                return -errno.EIO
+        # Looked up once on open, rather than taking the lock every write.
+        # Whether the session is still there is checked on release.
+        if self.upload_cb is None:
+            return -errno.EIO
 
         with self.iolock:
             if offset != len(self.data):
@@ -128,14 +149,14 @@ class DiscordUploaderFile:
                 self.efbig_hit = True
                 return -errno.EFBIG
 
-            self.data += buf
+            self.data.extend(buf)
             return len(buf)
 
     def release(self, flags):
         if self.data and not self.efbig_hit:
             with discord_upload_callbacks_lock:
                 if self.uuid in discord_upload_callbacks:
-                    discord_upload_callbacks[self.uuid](self.data)
+                    self.upload_cb(self.data)
 
 
 class DiscordUploaderFS(fuse.Fuse):
@@ -204,15 +225,14 @@ def recv_fd(sock):
     raise RuntimeError('no fd received')
 
 
-def read_one_pkt(sock):
-    # Normally I'd write C, but Python's recv seems to resize the buffer to
-    # the number returned by the recv syscall (if number passed into recv is
-    # positive), so... cool
-    buf = sock.recv(1, socket.MSG_PEEK | socket.MSG_TRUNC)
-    if not buf:
-        return b''
+def read_one_pkt(sock, buf):
+    # One recv gets one whole packet. With MSG_TRUNC it returns the real
+    # length of the packet, even if that is more than buf could take.
+    n = sock.recv_into(buf, 0, socket.MSG_TRUNC)
+    if n > len(buf):
+        raise RuntimeError('packet too large')
 
-    return sock.recv(len(buf))
+    return bytes(buf[:n])
 
 
 class RestartException(Exception):
@@ -229,6 +249,10 @@ class osaibot_command(enum.IntEnum):
     CMD_SIGNAL = 2
 
 
+CMD_INPUT_PREFIX = struct.pack('=b', osaibot_command.CMD_INPUT)
+CMD_SIGNAL_STRUCT = struct.Struct('=bi')
+
+
 @enum.unique
 class osaibot_response(enum.IntEnum):
     RESP_PROMPT = 1
@@ -248,87 +272,153 @@ class FlushType(enum.Enum):
     FORCED = enum.auto()
 
 
-def make_rate_limiter(min_delay):
-    last_ts = 0
+# PTM output read but not yet handled, reading pauses beyond this
+PTM_PENDING_MAX = 1 << 16
+# Largest cmdsock packet we take
+CMD_PKT_MAX = 1 << 18
+# Output kept for the terminal emulator while in IN_EXEC_DIRECT
+TE_PENDING_MAX = 1 << 16
 
-    async def rate_limiter():
-        nonlocal last_ts
 
-        now = time.monotonic()
-        least = last_ts + min_delay
-        if now < least:
-            await asyncio.sleep(least - now)
+# SGR, and bash's bracketed paste mode which we ignore too. OSC: set
+# palette, reset palette, or anything up to BEL or ST, whichever is first
+SGR_OSC_RE = re.compile(
+    br'\x1b(?:'
+    br'\[(?:[0-9;]*m|\?2004[hl])|'
+    br'\](?:P.{6}|R|[^PR].*?(?:\x07|\x1b\\))'
+    br')', re.DOTALL)
 
-        last_ts = time.monotonic()
-
-    return rate_limiter
+# Data that ends in the middle of one of the above, where we can't tell yet
+SGR_OSC_PARTIAL_RE = re.compile(
+    br'\x1b(?:'
+    br'\[(?:[0-9;]*|\?(?:2(?:0(?:0(?:4)?)?)?)?)|'
+    br'\](?:P.{0,5}|[^PR].*)?'
+    br')?', re.DOTALL)
 
 
+# Raises IndexError if data ends before it can be determined
 def check_sgr_osc(data, ind):
-    if data[ind + 1] == b'['[0]:
-        # CSI
-
-        # Bash uses bracketed paste mode. Ignore this too
-        if (
-            data[ind + 2] == b'?'[0] and
-            data[ind + 3] == b'2'[0] and
-            data[ind + 4] == b'0'[0] and
-            data[ind + 5] == b'0'[0] and
-            data[ind + 6] == b'4'[0] and
-            data[ind + 7] in (b'h'[0], b'l'[0])
-        ):
-            return True, ind + 8
-
-        for i in itertools.count(ind + 2):
-            if data[i] == b'm'[0]:  # SGR
-                return True, i + 1
-            elif data[i] == b';'[0]:
-                continue
-            elif b'0'[0] <= data[i] <= b'9'[0]:
-                continue
-            else:
-                return False, None
-    elif data[ind + 1] == b']'[0]:
-        # OSC
-        if data[ind + 2] == b'P'[0]:
-            # set palette
-            data[ind + 8]
-            return True, ind + 9
-        elif data[ind + 2] == b'R'[0]:
-            # reset palette
-            return True, ind + 3
-        else:
-            for i in itertools.count(ind + 3):
-                if data[i] == 7:  # BEL termination
-                    return True, i + 1
-                elif (
-                    data[i] == 0x1b and
-                    data[i + 1] == b'\\'[0]
-                ):  # ST termination
-                    return True, i + 2
-                else:
-                    continue
+    match = SGR_OSC_RE.match(data, ind)
+    if match:
+        return True, match.end()
+    elif SGR_OSC_PARTIAL_RE.fullmatch(data, ind):
+        raise IndexError
     else:
         return False, None
 
 
 def trim_sgr_osc(data, assert_is):
-    last_ind = -1
-    while True:
-        last_ind = data.find(b'\x1b', last_ind + 1)
-        if last_ind < 0:
-            break
+    data = SGR_OSC_RE.sub(b'', data)
+    # An ESC that is left is not part of any SGR or OSC
+    assert not assert_is or b'\x1b' not in data
+    return data
 
-        is_sgr_osc, end_ind = check_sgr_osc(data, last_ind)
-        assert not assert_is or is_sgr_osc
 
-        if is_sgr_osc:
-            data = (data[:last_ind] + data[end_ind:])
+# The bot expects no CR right before a LF, however many there are
+CRS_LF_RE = re.compile(br'\r+\n')
 
-            diff = end_ind - last_ind
-            last_ind = end_ind - diff - 1
+# CSI as in ECMA-48: parameter bytes, intermediate bytes, final byte
+CSI_RE = re.compile(br'\x1b\[[0-?]*[ -/]*[@-~]')
 
-    return data
+
+def strip_ansi(data):
+    # Single pass over data, jumping from ESC to ESC. SGR & OSC are
+    # handled by check_sgr_osc, any other CSI or two-byte escape is
+    # dropped as a whole, and a stray ESC is dropped on its own.
+    out = bytearray()
+    read = 0
+    pos = data.find(b'\x1b')
+    while pos >= 0:
+        out += data[read:pos]
+
+        try:
+            is_sgr_osc, end_ind = check_sgr_osc(data, pos)
+        except IndexError:
+            is_sgr_osc = False
+
+        if not is_sgr_osc:
+            end_ind = pos + 1
+            if pos + 1 < len(data):
+                introducer = data[pos + 1]
+                if introducer == b'['[0]:
+                    m = CSI_RE.match(data, pos)
+                    if m:
+                        end_ind = m.end()
+                elif b'@'[0] <= introducer <= b'_'[0]:
+                    end_ind = pos + 2
+
+        read = end_ind
+        pos = data.find(b'\x1b', read)
+
+    out += data[read:]
+
+    # If still unsupported stuffs left, delete them
+    return bytes(out.translate(None, b'\r\b\x7f'))
+
+
+# The same few prompts come back after every command
+@functools.lru_cache(maxsize=16)
+def prompt_frame(payload):
+    # Trim anything ANSI in prompt
+    prompt = strip_ansi(payload)
+
+    return json_dumps({
+        'type': 'PROMPT',
+        'payload': prompt.decode(errors='replace'),
+    }) + b'\n'
+
+
+# Controls that move the cursor up or change state pyte keeps
+TE_CTRL_RE = re.compile(rb'[\x00-\x06\x0b-\x0c\x0e-\x1a\x1c-\x1f\x7f]|'
+                        rb'\xc2[\x80-\x9f]')
+
+
+def te_pending_cut(data):
+    # Where data, fed to a fresh screen, can be cut without changing what
+    # ends up on it, or -1. With nothing but text, SGR, OSC, and controls
+    # that never go up a line, only the last 24 lines can be on screen,
+    # so everything before the 24th last CRLF can go.
+    ind = len(data)
+    for _ in range(24):
+        ind = data.rfind(b'\r\n', len(data) - TE_PENDING_MAX // 2, ind)
+        if ind < 0:
+            return -1
+    cut = ind + 2
+
+    pos = 0
+    while True:
+        esc_ind = data.find(b'\x1b', pos)
+        if TE_CTRL_RE.search(
+                data, pos, len(data) if esc_ind < 0 else esc_ind):
+            return -1
+        if esc_ind < 0:
+            return cut
+
+        match = SGR_OSC_RE.match(data, esc_ind)
+        if match is None or esc_ind < cut < match.end():
+            return -1
+        pos = match.end()
+
+
+def utf8_floor(data, ind, lo):
+    # Move ind back, but not past lo, so data[:ind] doesn't end in the
+    # middle of a UTF-8 sequence
+    i = ind - 1
+    while i > lo and i > ind - 4 and data[i] & 0xc0 == 0x80:
+        i -= 1
+
+    if i < lo:
+        return ind
+    elif data[i] >= 0xf0:
+        seqlen = 4
+    elif data[i] >= 0xe0:
+        seqlen = 3
+    elif data[i] >= 0xc0:
+        seqlen = 2
+    else:
+        return ind
+
+    return i if i + seqlen > ind else ind
 
 
 async def reader_wait_cb(fd, cb):
@@ -354,10 +444,10 @@ async def reader_wait_cb(fd, cb):
     return await fut
 
 
-async def writeall(fd, data):
+# Writes all of bufs, a list that is consumed in the process
+async def writeall(fd, bufs):
     loop = asyncio.get_running_loop()
     fut = loop.create_future()
-    view = memoryview(data)
     pos = 0
 
     def writer_cb():
@@ -366,9 +456,8 @@ async def writeall(fd, data):
         if fut.done():
             return
 
-        start = pos
         try:
-            n = os.write(fd, view[start:])
+            n = os.writev(fd, bufs[pos:pos + IOV_MAX])
         except (BlockingIOError, InterruptedError):
             return
         except (SystemExit, KeyboardInterrupt):
@@ -377,12 +466,16 @@ async def writeall(fd, data):
             fut.set_exception(exc)
             return
 
-        start += n
+        # Skip what is fully written, only the buffer that is partly
+        # written needs to be sliced
+        while pos < len(bufs) and n >= len(bufs[pos]):
+            n -= len(bufs[pos])
+            pos += 1
 
-        if start == len(view):
+        if pos == len(bufs):
             fut.set_result(None)
-        else:
-            pos = start
+        elif n:
+            bufs[pos] = memoryview(bufs[pos])[n:]
 
     loop.add_writer(fd, writer_cb)
     fut.add_done_callback(lambda fut: loop.remove_writer(fd))
@@ -418,14 +511,9 @@ class Comm():
         self.bot_writer = writer
 
         self.loop = asyncio.get_running_loop()
-        self.killer = self.loop.create_future()
-        self.rate_limit = make_rate_limiter(1.2)
+        self.last_bot_response = 0
         self.bot_response_lock = asyncio.Lock()
 
-        self.exec_drain = set()
-        self.write_tasks = set()
-        self.next_cmd_ptm = set()
-
     @staticmethod
     def raise_restart(*args):
         raise RestartException
@@ -443,77 +531,123 @@ class Comm():
             lambda fd: recv_fd(self.cmdsock))
 
     async def bot_response(self, data):
-        async with self.bot_response_lock:
-            await self.rate_limit()
+        await self.bot_send([json_dumps(data), b'\n'])
+
+    async def bot_send(self, bufs, rate_limit=True):
+        # Rate limit. The next free slot is taken right away, so the lock
+        # below is not held while waiting for it, and responses still go
+        # out in the order they were made.
+        if rate_limit:
+            now = time.monotonic()
+            slot = max(self.last_bot_response + 1.2, now)
+            self.last_bot_response = slot
+            if slot > now:
+                await asyncio.sleep(slot - now)
 
-            self.bot_writer.write(json.dumps(data).encode() + b'\n')
+        async with self.bot_response_lock:
+            self.bot_writer.writelines(bufs)
             await self.bot_writer.drain()
 
     async def handle_ptm(self, data, flushtype):
         data = data.replace(b'\x00', b'')
 
-        if data and self.te_stream:
-            self.te_stream.feed(data.decode(errors='replace'))
+        if self.term_state == TermState.IN_EXEC_TERMEMU:
+            if data:
+                self.te_stream.feed(data)
+        elif self.term_state == TermState.IN_EXEC_DIRECT:
+            # The screen is only looked at once we switch to
+            # IN_EXEC_TERMEMU, so keep the bytes until then
+            pending = self.te_pending
+            if pending is None:
+                # Gave up on keeping them, see below
+                self.te_stream.feed(data)
+            else:
+                pending += data
+                if len(pending) > TE_PENDING_MAX:
+                    cut = te_pending_cut(pending)
+                    if cut >= 0:
+                        del pending[:cut]
+                    else:
+                        # No safe place to cut, bring the screen up to
+                        # date and keep it so for the rest of the command
+                        self.te_stream.feed(pending)
+                        self.te_pending = None
 
         flush_wait = False
 
-        while True:
-            data, self.pending_out = self.pending_out + data, b''
+        # Everything not yet sent lives in pending_out. Work on it in
+        # place, with buf[start:] being what is left to handle.
+        buf = self.pending_out
+        buf += data
+        start = 0
 
+        while True:
             if self.term_state == TermState.IN_EXEC_DIRECT:
                 # Figure out if we should switch to IN_EXEC_TERMEMU
                 # We end this part at a erase character, or
                 # an ANSI escape code that isn't SGR.
                 should_switch = False
+                end = len(buf)
 
                 # Erase character, either ^H or ^?
-                if b'\b' in data or b'\x7f' in data:
+                if (
+                    buf.find(b'\b', start) >= 0 or
+                    buf.find(b'\x7f', start) >= 0
+                ):
                     should_switch = True
 
                 if not should_switch:
-                    # Check for SGR & OSC
-                    last_ind = -1
-                    while True:
-                        last_ind = data.find(b'\x1b', last_ind + 1)
-                        if last_ind < 0:
-                            break
-
-                        try:
-                            is_sgr_osc, ind_end = check_sgr_osc(
-                                data, last_ind)
-                        except IndexError:
-                            # Not enough data to determine
-                            # SGR & OSC
-                            data, self.pending_out = (
-                                data[:last_ind],
-                                data[last_ind:] + self.pending_out)
+                    # Check for SGR & OSC. Walk the sequences up to
+                    # the first ESC that isn't one.
+                    has_sgr_osc = False
+                    pos = start
+                    for match in SGR_OSC_RE.finditer(buf, start):
+                        if buf.find(b'\x1b', pos, match.start()) >= 0:
                             break
 
-                        if is_sgr_osc:
-                            last_ind = ind_end - 1
-                            continue
+                        has_sgr_osc = True
+                        pos = match.end()
 
-                        # Not SGR or OSC, switch
-                        should_switch = True
-                        break
+                    esc_ind = buf.find(b'\x1b', pos)
+                    if esc_ind >= 0:
+                        if SGR_OSC_PARTIAL_RE.fullmatch(buf, esc_ind):
+                            # Not enough data to determine
+                            # SGR & OSC, keep it for later
+                            end = esc_ind
+                        else:
+                            # Not SGR or OSC, switch
+                            should_switch = True
 
                 if should_switch:
-                    data = b''
+                    if self.te_pending is not None:
+                        self.te_stream.feed(self.te_pending)
+                        self.te_pending.clear()
+
+                    buf.clear()
+                    start = 0
                     self.term_state = TermState.IN_EXEC_TERMEMU
                     continue
 
-                # Trim SGR & OSC
-                data = trim_sgr_osc(data, True)
+                if has_sgr_osc or buf.find(b'\r\n', start, end) >= 0:
+                    # Trim SGR & OSC
+                    data = trim_sgr_osc(buf[start:end], True)
+
+                    data = CRS_LF_RE.sub(b'\n', data)
+
+                    buf[start:end] = data
+                    end = start + len(data)
 
-                while data and data[-1] == b'\r':
-                    data, self.pending_out = \
-                        data[:-1], data[-1] + self.pending_out
+                # Unless forced, when nothing more is coming
+                if flushtype != FlushType.FORCED:
+                    # Hold back trailing CRs, a LF may follow
+                    while end > start and buf[end - 1] == b'\r'[0]:
+                        end -= 1
 
-                while b'\r\n' in data:
-                    data = data.replace(b'\r\n', b'\n')
+                    # And a trailing incomplete UTF-8 sequence
+                    end = utf8_floor(buf, end, start)
 
                 has_pending_from_limit = False
-                if data:
+                if end > start:
                     # Operation:
                     # IF_NECESSARY =>
                     # Flush if we reach character limit
@@ -527,11 +661,9 @@ class Comm():
 
                     # Flush if we are over 2000 chars, because of
                     # discord limit, and it is necessary to flush
-                    if len(data) > 2000:
+                    if end - start > 2000:
                         should_flush = True
-                        data, self.pending_out = (
-                            data[:2000],
-                            data[2000:] + self.pending_out)
+                        end = utf8_floor(buf, start + 2000, start)
 
                         # cause another iteration
                         has_pending_from_limit = True
@@ -539,53 +671,60 @@ class Comm():
                     # try to split on last linebreak if there
                     # is one, if we are not forced to flush
                     if flushtype != FlushType.FORCED:
-                        nr_ind = data.rfind(b'\n')
-                        if nr_ind >= 0 and nr_ind != len(data) - 1:
-                            data, self.pending_out = (
-                                data[:nr_ind + 1],
-                                data[nr_ind + 1:] + self.pending_out)
+                        nr_ind = buf.rfind(b'\n', start, end)
+                        if nr_ind >= 0 and nr_ind != end - 1:
+                            end = nr_ind + 1
                             flush_wait = True
 
                     if should_flush:
+                        # Decode without copying the slice first. The
+                        # view must be gone before buf is resized.
+                        with memoryview(buf) as view:
+                            payload = str(
+                                view[start:end], 'utf-8', 'replace')
+
                         await self.bot_response({
                             'type': 'DIRECT',
-                            'payload': data.decode(errors='replace'),
+                            'payload': payload,
                         })
                         self.last_ptm_flush = time.monotonic()
+                        start = end
                     else:
-                        data, self.pending_out = (
-                            b'', data + self.pending_out)
                         flush_wait = True
-                        should_switch = False
 
                 if has_pending_from_limit:
-                    data = b''
                     continue
                 else:
                     break
             elif self.term_state == TermState.IN_EXEC_TERMEMU:
+                buf.clear()
+                start = 0
+
                 if flushtype != FlushType.IF_NECESSARY:
-                    display = ' ' * (self.te_screen.cursor.x + 1)
-                    display += '|\n'
+                    cursor = self.te_screen.cursor
+                    display = [' ' * (cursor.x + 1) + '|']
 
                     for i, line in enumerate(self.te_screen.display):
-                        display += (
-                            '-' if self.te_screen.cursor.y == i
-                            else ' ')
-                        display += line.rstrip() + '\n'
+                        display.append(
+                            ('-' if cursor.y == i else ' ') +
+                            line.rstrip())
+
+                    display.append('')
 
                     await self.bot_response({
                         'type': 'DISPLAY',
-                        'payload': display,
+                        'payload': '\n'.join(display),
                     })
                     self.last_ptm_flush = time.monotonic()
                 else:
                     flush_wait = True
                 break
             else:
-                self.pending_out = b''
+                buf.clear()
+                start = 0
                 break
 
+        del buf[:start]
         self.has_flush_wait = flush_wait
 
     async def handle_cmd(self, cmd, payload):
@@ -601,28 +740,7 @@ class Comm():
                 if not task.done():
                     task.cancel()
 
-            prompt = payload
-
-            # Trim SGR & OSC
-            with contextlib.suppress(IndexError):
-                prompt = trim_sgr_osc(prompt, False)
-
-            # Trim anything ANSI in prompt
-            # This doesn't Trim OSC properly
-            # regex from
-            # https://stackoverflow.com/a/14693789
-            prompt = re.sub(
-                br'(?:\x1B[@-Z\\-_]|[\x80-\x9A\x9C-\x9F]|'
-                br'(?:\x1B\[|\x9B)[0-?]*[ -/]*[@-~])',
-                b'', prompt)
-
-            # If still unsupported stuffs left, delete them
-            prompt.translate(None, b'\x1b\r\b\x7f')
-
-            await self.bot_response({
-                'type': 'PROMPT',
-                'payload': prompt.decode(errors='replace'),
-            })
+            await self.bot_send([prompt_frame(payload)])
         elif cmd == osaibot_response.RESP_BEGIN:
             self.term_state = TermState.IN_EXEC_DIRECT
 
@@ -630,113 +748,183 @@ class Comm():
             self.te_screen.write_process_input = (
                 lambda data: os.write(
                     self.ptm_fd, data.encode()))
-            self.te_stream = pyte.Stream(self.te_screen)
+            # Decodes UTF-8 incrementally, so characters split between
+            # reads come out right
+            self.te_stream = pyte.ByteStream(self.te_screen)
+            self.te_pending = bytearray()
+            self.pending_out = bytearray()
+
+            # Input from now on goes to the PTM. Not a chat message, so
+            # don't spend the rate limit on it.
+            await self.bot_send([json_dumps({'type': 'READY'}), b'\n'],
+                                rate_limit=False)
         else:
             raise AssertionError
 
     async def on_cmd_ptm(self):
-        self.pending_out = b''
+        self.pending_out = bytearray()
         self.te_screen = None
         self.te_stream = None
+        self.te_pending = bytearray()
+
+        # The readers stay registered and keep what they read here until
+        # the loop below picks it up. PTM output is coalesced, cmd
+        # packets are taken one at a time.
+        ptm_in = bytearray()
+        ptm_read_buf = bytearray(65536)
+        ptm_read_view = memoryview(ptm_read_buf)
+        ptm_exc = None
+        ptm_paused = False
+        cmd_buf = memoryview(bytearray(CMD_PKT_MAX))
+        cmd_in = None
+        cmd_exc = None
+        waiter = None
+
+        def wakeup():
+            if waiter is not None and not waiter.done():
+                waiter.set_result(None)
+
+        def ptm_reader_cb():
+            nonlocal ptm_exc, ptm_paused
+
+            # The PTY hands out a few KiB per read, take everything it
+            # has in one go
+            while len(ptm_in) < PTM_PENDING_MAX:
+                try:
+                    n = os.readv(self.ptm_fd, [ptm_read_buf])
+                except (BlockingIOError, InterruptedError):
+                    break
+                except Exception as exc:
+                    ptm_exc = exc
+                    break
+
+                if not n:
+                    ptm_exc = RestartException()
+                    break
 
-        def gen_ptm_task():
-            return asyncio.create_task(reader_wait_cb(
-                self.ptm_fd,
-                lambda fd: ('ptm', os.read(fd, 1024))))
+                ptm_in.extend(ptm_read_view[:n])
 
-        def gen_cmd_task():
-            def decode_cmd(data):
-                if not data:
-                    raise RestartException
+            if ptm_exc is not None or len(ptm_in) >= PTM_PENDING_MAX:
+                self.loop.remove_reader(self.ptm_fd)
+                ptm_paused = True
+
+            # A readiness with nothing to read would pass for the timeout
+            if ptm_in or ptm_exc is not None:
+                wakeup()
 
-                return data[0], data[1:]
+        def cmd_reader_cb():
+            nonlocal cmd_in, cmd_exc
 
-            return asyncio.create_task(reader_wait_cb(
-                self.cmdsock.fileno(),
-                lambda fd: ('cmd', decode_cmd(
-                    read_one_pkt(self.cmdsock)))))
+            try:
+                data = read_one_pkt(self.cmdsock, cmd_buf)
+            except (BlockingIOError, InterruptedError):
+                return
+            except Exception as exc:
+                cmd_exc = exc
+            else:
+                if data:
+                    cmd_in = data[0], data[1:]
+                else:
+                    cmd_exc = RestartException()
+
+            self.loop.remove_reader(self.cmdsock.fileno())
+            wakeup()
+
+        def has_input():
+            return (
+                bool(ptm_in) or ptm_exc is not None or
+                cmd_in is not None or cmd_exc is not None)
 
         self.last_ptm_flush = time.monotonic()
         self.has_flush_wait = False
-        self.next_cmd_ptm = {gen_ptm_task(), gen_cmd_task()}
 
-        while True:
-            if self.has_flush_wait:
-                # Aggregate output, throttle to flush
-                # when 0.5 secs timeout
-                timeout = self.last_ptm_flush + 0.5 - time.monotonic()
-                timeout = max(0, timeout)
-            else:
-                timeout = None
-
-            if timeout is not None and timeout <= 0:
-                await self.handle_ptm(b'', FlushType.HIT_TIMER)
-                continue
-
-            done, self.next_cmd_ptm = await asyncio.wait(
-                self.next_cmd_ptm, timeout=timeout,
-                return_when=asyncio.FIRST_COMPLETED)
-
-            if not done:
-                # Timeout hit, flush
-                await self.handle_ptm(b'', FlushType.HIT_TIMER)
-                continue
-
-            if self.next_cmd_ptm:
-                # Try to get more resolved, else if one task is already
-                # resolved (due to race tiebreaker), asyncio.wait will
-                # immediately return
-                done_2nd, self.next_cmd_ptm = await asyncio.wait(
-                    self.next_cmd_ptm, timeout=0,
-                    return_when=asyncio.FIRST_COMPLETED)
-                done |= done_2nd
-
-            # If we don't have timeout, we have potentially waited long time
-            # start last_ptm_flush from now so the next timeout won't be zero
-            if timeout is None:
-                self.last_ptm_flush = time.monotonic()
-
-            done_dict = {}
-            for task in done:
-                src, _ = await task
-                assert src not in done_dict
-                done_dict[src] = task
-
-            # Race tiebreaker
-            if 'ptm' in done_dict and 'cmd' in done_dict:
-                _, (cmd, _) = await done_dict['cmd']
-                if (
-                    self.term_state == TermState.IN_PROMPT and
-                    cmd == osaibot_response.RESP_BEGIN
-                ):
-                    # Transition: Prompt -> Exec, cmd gets priorty
-                    drop = 'ptm'
-                elif cmd == osaibot_response.RESP_PROMPT:
-                    # Transition: Exec -> Prompt, ptm gets priorty
-                    drop = 'cmd'
+        self.loop.add_reader(self.ptm_fd, ptm_reader_cb)
+        self.loop.add_reader(self.cmdsock.fileno(), cmd_reader_cb)
+        try:
+            while True:
+                if self.has_flush_wait:
+                    # Aggregate output, throttle to flush
+                    # when 0.5 secs timeout
+                    timeout = (
+                        self.last_ptm_flush + 0.5 - time.monotonic())
+                    timeout = max(0, timeout)
                 else:
-                    # Misc. cmd, cmd gets priorty
-                    drop = 'ptm'
+                    timeout = None
 
-                drop_task = done_dict[drop]
-                done.remove(drop_task)
-                self.next_cmd_ptm.add(drop_task)
+                if timeout is not None and timeout <= 0:
+                    await self.handle_ptm(b'', FlushType.HIT_TIMER)
+                    continue
+
+                if not has_input():
+                    waiter = self.loop.create_future()
+                    timer = None
+                    if timeout is not None:
+                        timer = self.loop.call_later(timeout, wakeup)
+
+                    try:
+                        await waiter
+                    finally:
+                        waiter = None
+                        if timer is not None:
+                            timer.cancel()
+
+                    if not has_input():
+                        # Timeout hit, flush
+                        await self.handle_ptm(b'', FlushType.HIT_TIMER)
+                        continue
+
+                # If we don't have timeout, we have potentially waited
+                # long time start last_ptm_flush from now so the next
+                # timeout won't be zero
+                if timeout is None:
+                    self.last_ptm_flush = time.monotonic()
+
+                if cmd_exc is not None:
+                    raise cmd_exc
+
+                has_ptm = bool(ptm_in) or ptm_exc is not None
+
+                # Race tiebreaker
+                # Transition: Exec -> Prompt, ptm gets priorty
+                # Transition: Prompt -> Exec, cmd gets priorty
+                # Misc. cmd, cmd gets priorty
+                # If cmd gets priority, ptm is handled next time around
+                if (
+                    has_ptm and cmd_in is not None and
+                    cmd_in[0] != osaibot_response.RESP_PROMPT
+                ):
+                    has_ptm = False
 
-            for task in done:
-                src, data = await task
-                if src == 'ptm':
-                    if not data:
-                        raise RestartException
+                if has_ptm:
+                    if not ptm_in:
+                        raise ptm_exc
 
-                    self.next_cmd_ptm.add(gen_ptm_task())
+                    data = bytes(ptm_in)
+                    ptm_in.clear()
+                    if ptm_paused and ptm_exc is None:
+                        self.loop.add_reader(self.ptm_fd, ptm_reader_cb)
+                        ptm_paused = False
 
                     await self.handle_ptm(data, FlushType.IF_NECESSARY)
-                elif src == 'cmd':
-                    cmd, payload = data
 
-                    self.next_cmd_ptm.add(gen_cmd_task())
+                    # More output may have come in while handle_ptm was
+                    # waiting to send, it still goes before the prompt
+                    if (
+                        cmd_in is not None and
+                        cmd_in[0] == osaibot_response.RESP_PROMPT
+                    ):
+                        continue
+
+                if cmd_in is not None:
+                    cmd, payload = cmd_in
+                    cmd_in = None
+                    self.loop.add_reader(
+                        self.cmdsock.fileno(), cmd_reader_cb)
 
                     await self.handle_cmd(cmd, payload)
+        finally:
+            self.loop.remove_reader(self.ptm_fd)
+            self.loop.remove_reader(self.cmdsock.fileno())
 
     async def on_botmsg(self):
         cmd_lock = asyncio.Lock()
@@ -766,19 +954,30 @@ class Comm():
                     self.exec_drain.discard(task)
 
             task.add_done_callback(done_cb)
+            return task
+
+        # Inputs for the PTM are queued here, and a single task writes
+        # everything queued so far with one writev
+        ptm_pending = []
+        ptm_writer = None
+
+        async def write_ptm_pending():
+            while ptm_pending:
+                bufs = ptm_pending[:]
+                ptm_pending.clear()
+                await writeall(self.ptm_fd, bufs)
 
         while True:
             data = (await self.bot_reader.readline()).strip()
             if not data:
                 raise BotClosedException
 
-            data = json.loads(data)
+            data = json_loads(data)
 
             if data['type'] == 'INPUT':
                 payload = data['payload']
                 if self.term_state == TermState.IN_PROMPT:
-                    payload = (struct.pack('=b', osaibot_command.CMD_INPUT)
-                               + payload.encode())
+                    payload = CMD_INPUT_PREFIX + payload.encode()
                     make_write_task(
                         cmd_lock, False,
                         self.loop.sock_sendall(self.cmdsock, payload))
@@ -787,18 +986,23 @@ class Comm():
                     TermState.IN_EXEC_TERMEMU,
                 ]:
                     # For some reason, Enter is CR not NL
-                    payload = payload.replace('\n', '\r').encode()
-                    make_write_task(
-                        ptm_lock, True,
-                        writeall(self.ptm_fd, payload))
+                    payload = payload.encode().replace(b'\n', b'\r')
+                    if ptm_writer is None or ptm_writer.done():
+                        # Anything left was dropped when returning to
+                        # prompt
+                        ptm_pending.clear()
+                        ptm_writer = make_write_task(
+                            ptm_lock, True, write_ptm_pending())
+
+                    ptm_pending.append(payload)
             elif data['type'] == 'SIGNAL':
                 if self.term_state in [
                     TermState.IN_EXEC_DIRECT,
                     TermState.IN_EXEC_TERMEMU,
                 ]:
                     signum = data['signum']
-                    payload = struct.pack(
-                        '=bi', osaibot_command.CMD_SIGNAL, signum)
+                    payload = CMD_SIGNAL_STRUCT.pack(
+                        osaibot_command.CMD_SIGNAL, signum)
                     make_write_task(
                         cmd_lock, True,
                         self.loop.sock_sendall(self.cmdsock, payload))
@@ -808,10 +1012,12 @@ class Comm():
     def upload_cb(self, data):
         async def _upload_cb_inner():
             try:
-                await self.bot_response({
-                    'type': 'UPLOAD',
-                    'payload': base64.b64encode(data).decode(),
-                })
+                # Base64 needs no escaping in JSON, so put the frame
+                # together directly rather than going through str
+                await self.bot_send([
+                    b'{"type":"UPLOAD","payload":"',
+                    base64.b64encode(data),
+                    b'"}\n'])
             except asyncio.CancelledError:
                 pass
             except BaseException as e:
@@ -832,11 +1038,17 @@ class Comm():
         discord_upload_callbacks[str(self.uuid)] = self.upload_cb
 
         try:
-            await self._run()
+            idname, reinit = await self.read_init()
+
+            # The connection stays up across restarts; only the first jail
+            # honours the reinit from the bot
+            while True:
+                await self._run(idname, reinit)
+                reinit = False
         finally:
             del discord_upload_callbacks[str(self.uuid)]
 
-    async def _run(self):
+    async def read_init(self):
         idname = None
         reinit = False
 
@@ -846,19 +1058,26 @@ class Comm():
                 if not data:
                     raise BotClosedException
 
-                data = json.loads(data)
+                data = json_loads(data)
                 assert data['type'] == 'INIT'
 
                 nonlocal idname, reinit
                 idname = data['idname']
                 reinit = data['reinit']
 
-                assert re.match(r'^[a-zA-Z0-9]{1,30}$', idname)
+                assert IDNAME_RE.match(idname)
             await asyncio.wait_for(read_idname(), 1)
         except Exception:
             traceback.print_exc()
             raise BotClosedException
 
+        return idname, reinit
+
+    async def _run(self, idname, reinit):
+        self.killer = self.loop.create_future()
+        self.exec_drain = set()
+        self.write_tasks = set()
+
         run = os.path.join(CONTAINER_RUN, idname)
         run_exists = os.path.exists(run)
         rootdir = os.path.join(run, 'root')
@@ -986,7 +1205,7 @@ class Comm():
                 if not task.done():
                     task.cancel()
 
-            for task in tasks | self.next_cmd_ptm:
+            for task in tasks:
                 if not task.done():
                     task.cancel()
 
@@ -997,21 +1216,20 @@ class Comm():
                 except Exception:
                     traceback.print_exc()
 
-            if self.bwrap_pidfd is not None:
-                with contextlib.suppress(OSError):
-                    signal.pidfd_send_signal(
-                        self.bwrap_pidfd, signal.SIGKILL, None, 0)
-                os.close(self.bwrap_pidfd)
-            if self.bash_pidfd is not None:
-                with contextlib.suppress(OSError):
-                    signal.pidfd_send_signal(
-                        self.bash_pidfd, signal.SIGKILL, None, 0)
-                os.close(self.bash_pidfd)
-            if self.slirp4netns_pidfd is not None:
-                with contextlib.suppress(OSError):
-                    signal.pidfd_send_signal(
-                        self.slirp4netns_pidfd, signal.SIGTERM, None, 0)
-                os.close(self.slirp4netns_pidfd)
+            # Signal everything first so the processes die in parallel,
+            # then close the pidfds
+            pidfds = [(self.bwrap_pidfd, signal.SIGKILL),
+                      (self.bash_pidfd, signal.SIGKILL),
+                      (self.slirp4netns_pidfd, signal.SIGTERM)]
+
+            for pidfd, sig in pidfds:
+                if pidfd is not None:
+                    with contextlib.suppress(OSError):
+                        signal.pidfd_send_signal(pidfd, sig, None, 0)
+
+            for pidfd, sig in pidfds:
+                if pidfd is not None:
+                    os.close(pidfd)
 
             if self.netnsfd is not None:
                 os.close(self.netnsfd)
@@ -1046,10 +1264,11 @@ async def main():
     threading.Thread(target=fuse_thread, daemon=True).start()
 
     async def handle_connection(reader, writer):
+        # Have drain() wait until responses are handed to the kernel
+        writer.transport.set_write_buffer_limits(0)
+
         try:
-            while True:
-                comm = Comm(reader, writer)
-                await comm.run()
+            await Comm(reader, writer).run()
         except BotClosedException:
             pass
         finally:
@@ -3,12 +3,44 @@ import json
 import signal
 import unittest
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if orjson is not None:
+    json_dumps = orjson.dumps
+    json_loads = orjson.loads
+else:
+    def json_dumps(obj):
+        return json.dumps(
+            obj, separators=(',', ':'), ensure_ascii=False).encode()
+
+    json_loads = json.loads
+
+
+SIMPLE_PROMPT = {"type": "PROMPT", "payload": "root@NSJAIL:/# "}
+
+# head -c 1024 /dev/zero | xxd, as less shows it
+XXD_ZERO_ROWS = ''.join(
+    f"O{offset:08x}: {'0000 ' * 7}0000  ................\n"
+    for offset in range(0, 0x170, 0x10))
+LESS_DISPLAY = "OOX" + "O" * 78 + "\n" + XXD_ZERO_ROWS + "X:\n"
+LESS_QUIT_DISPLAY = "OX" + "O" * 79 + "\n" + XXD_ZERO_ROWS + "X\n"
+
 
 class Test(unittest.IsolatedAsyncioTestCase):
     async def asyncSetUp(self):
+        # The largest frame is an UPLOAD of the 8 MiB /dev/discord
+        # allows, just under 11.2 MB as base64
         self.reader, self.writer = await asyncio.open_connection(
-            '127.0.0.1', 49813)
+            '127.0.0.1', 49813, limit=12 << 20)
+        # send() returns only once the message is with the kernel
+        self.writer.transport.set_write_buffer_limits(0)
 
+        # Like the bot does on connect. reinit gives every test a fresh
+        # root filesystem.
+        await self.send({"type": "INIT", "idname": "test", "reinit": True})
         await self.assert_simple_prompt()
 
     async def asyncTearDown(self):
@@ -16,19 +48,27 @@ class Test(unittest.IsolatedAsyncioTestCase):
         await self.writer.wait_closed()
 
     async def send(self, message):
-        self.writer.write(json.dumps(message).encode() + b'\n')
+        self.writer.writelines([json_dumps(message), b'\n'])
         await self.writer.drain()
 
-    async def recv(self, timeout=2):
-        data = await asyncio.wait_for(self.reader.readline(), timeout=timeout)
-        return json.loads(data.strip().decode())
+    async def recv(self, timeout=2, skip_ready=True):
+        while True:
+            data = await asyncio.wait_for(self.reader.readuntil(b'\n'),
+                                          timeout=timeout)
+            message = json_loads(data)
+            if not skip_ready or message['type'] != 'READY':
+                return message
+
+    async def wait_ready(self):
+        message = await self.recv(skip_ready=False)
+        self.assertEqual(message, {"type": "READY"})
 
     async def assertResp(self, expected, timeout=2):
         message = await self.recv(timeout=timeout)
         self.assertEqual(message, expected)
 
     async def assert_simple_prompt(self):
-        await self.assertResp({"type": "PROMPT", "payload": "root@NSJAIL:/# "})
+        await self.assertResp(SIMPLE_PROMPT)
 
     async def test_hello_world(self):
         await self.send({"type": "INPUT", "payload": "echo hello world\n"})
@@ -44,6 +84,19 @@ class Test(unittest.IsolatedAsyncioTestCase):
         await self.assertResp({"type": "DIRECT", "payload": "world\n"})
         await self.assert_simple_prompt()
 
+    async def test_output_before_prompt(self):
+        # Takes several rate limited messages, the prompt comes back
+        # while the output is still being sent
+        await self.send({"type": "INPUT", "payload": "seq 3000\n"})
+        output = ''
+        while True:
+            message = await self.recv()
+            if message['type'] != 'DIRECT':
+                break
+            output += message['payload']
+        self.assertEqual(output, ''.join(f'{i}\n' for i in range(1, 3001)))
+        self.assertEqual(message, SIMPLE_PROMPT)
+
     async def test_multiline_command(self):
         await self.send({"type": "INPUT", "payload": "echo hello &&\n"})
         await self.assertResp({"type": "PROMPT", "payload": "> "})
@@ -53,7 +106,7 @@ class Test(unittest.IsolatedAsyncioTestCase):
 
     async def test_input_is_echoed_line(self):
         await self.send({"type": "INPUT", "payload": "cat\n"})
-        await asyncio.sleep(0.5)
+        await self.wait_ready()
         await self.send({"type": "INPUT", "payload": "hello world\n"})
         await self.assertResp({"type": "DIRECT",
                                "payload": "hello world\nhello world\n"})
@@ -64,7 +117,7 @@ class Test(unittest.IsolatedAsyncioTestCase):
 
     async def test_input_is_echoed_partial(self):
         await self.send({"type": "INPUT", "payload": "cat\n"})
-        await asyncio.sleep(0.5)
+        await self.wait_ready()
         await self.send({"type": "INPUT", "payload": "hello "})
         await self.assertResp({"type": "DIRECT", "payload": "hello "})
         await self.send({"type": "INPUT", "payload": "world\n"})
@@ -89,59 +142,11 @@ class Test(unittest.IsolatedAsyncioTestCase):
 
     async def test_render_screen(self):
         await self.send({"type": "INPUT", "payload": "head -c 1024 /dev/zero | xxd | less\n"})
-        await self.assertResp({"type": "DISPLAY", "payload":
-            "OOXOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOO\n"
-            "O00000000: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O00000010: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O00000020: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O00000030: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O00000040: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O00000050: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O00000060: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O00000070: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O00000080: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O00000090: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O000000a0: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O000000b0: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O000000c0: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O000000d0: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O000000e0: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O000000f0: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O00000100: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O00000110: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O00000120: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O00000130: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O00000140: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O00000150: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O00000160: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "X:\n"})
+        await self.assertResp({"type": "DISPLAY",
+                               "payload": LESS_DISPLAY})
         await self.send({"type": "INPUT", "payload": "q"})
-        await self.assertResp({"type": "DISPLAY", "payload":
-            "OXOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOO\n"
-            "O00000000: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O00000010: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O00000020: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O00000030: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O00000040: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O00000050: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O00000060: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O00000070: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O00000080: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O00000090: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O000000a0: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O000000b0: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O000000c0: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O000000d0: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O000000e0: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O000000f0: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O00000100: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O00000110: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O00000120: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O00000130: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O00000140: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O00000150: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O00000160: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "X\n"})
+        await self.assertResp({"type": "DISPLAY",
+                               "payload": LESS_QUIT_DISPLAY})
         await self.assert_simple_prompt()
 
     async def test_input_flushed_on_prompt(self):
@@ -152,77 +157,29 @@ class Test(unittest.IsolatedAsyncioTestCase):
         # and then run cat upon next prompt, "\n" is still in the read buffer,
         # so cat will immediately output "\n"
         await self.send({"type": "INPUT", "payload": "head -c 1024 /dev/zero | xxd | less\n"})
-        await self.assertResp({"type": "DISPLAY", "payload":
-            "OOXOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOO\n"
-            "O00000000: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O00000010: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O00000020: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O00000030: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O00000040: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O00000050: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O00000060: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O00000070: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O00000080: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O00000090: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O000000a0: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O000000b0: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O000000c0: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O000000d0: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O000000e0: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O000000f0: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O00000100: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O00000110: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O00000120: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O00000130: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O00000140: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O00000150: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O00000160: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "X:\n"})
+        await self.assertResp({"type": "DISPLAY",
+                               "payload": LESS_DISPLAY})
         await self.send({"type": "INPUT", "payload": "q\n"})
-        await self.assertResp({"type": "DISPLAY", "payload":
-            "OXOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOO\n"
-            "O00000000: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O00000010: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O00000020: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O00000030: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O00000040: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O00000050: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O00000060: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O00000070: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O00000080: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O00000090: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O000000a0: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O000000b0: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O000000c0: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O000000d0: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O000000e0: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O000000f0: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O00000100: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O00000110: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O00000120: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O00000130: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O00000140: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O00000150: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "O00000160: 0000 0000 0000 0000 0000 0000 0000 0000  ................\n"
-            "X\n"})
+        await self.assertResp({"type": "DISPLAY",
+                               "payload": LESS_QUIT_DISPLAY})
         await self.assert_simple_prompt()
 
         await self.send({"type": "INPUT", "payload": "cat\n"})
-        await asyncio.sleep(0.5)
+        await self.wait_ready()
         await self.send({"type": "INPUT", "payload": "hello world\n"})
         await self.assertResp({"type": "DIRECT",
                                "payload": "hello world\nhello world\n"})
 
     async def test_tty_keys_job_ctrl(self):
         await self.send({"type": "INPUT", "payload": "cat\n"})
-        await asyncio.sleep(0.5)
+        await self.wait_ready()
         await self.send({"type": "INPUT", "payload": "\u001a"})
         await self.assertResp({"type": "DIRECT", "payload":
                                "^Z\n[1]+  Stopped                 cat\n"})
 
         await self.assert_simple_prompt()
         await self.send({"type": "INPUT", "payload": "fg\n"})
-        await asyncio.sleep(0.5)
+        await self.wait_ready()
         await self.assertResp({"type": "DIRECT", "payload": "cat\n"})
         await self.send({"type": "INPUT", "payload": "\u0003"})
         await self.assertResp({"type": "DIRECT", "payload": "^C\n"})
@@ -230,28 +187,28 @@ class Test(unittest.IsolatedAsyncioTestCase):
 
     async def test_signal(self):
         await self.send({"type": "INPUT", "payload": "cat\n"})
-        await asyncio.sleep(0.5)
+        await self.wait_ready()
         await self.send({"type": "SIGNAL", "signum": signal.SIGTSTP})
         await self.assertResp({"type": "DIRECT", "payload":
                                "\n[1]+  Stopped                 cat\n"})
         await self.assert_simple_prompt()
 
         await self.send({"type": "INPUT", "payload": "fg\n"})
-        await asyncio.sleep(0.5)
+        await self.wait_ready()
         await self.assertResp({"type": "DIRECT", "payload": "cat\n"})
         await self.send({"type": "SIGNAL", "signum": signal.SIGINT})
         await self.assertResp({"type": "DIRECT", "payload": "\n"})
         await self.assert_simple_prompt()
 
         await self.send({"type": "INPUT", "payload": "cat\n"})
-        await asyncio.sleep(0.5)
+        await self.wait_ready()
         await self.send({"type": "SIGNAL", "signum": signal.SIGTERM})
         await self.assertResp({"type": "DIRECT", "payload":
                                "Terminated\n"})
         await self.assert_simple_prompt()
 
         await self.send({"type": "INPUT", "payload": "cat\n"})
-        await asyncio.sleep(0.5)
+        await self.wait_ready()
         await self.send({"type": "SIGNAL", "signum": signal.SIGKILL})
         await self.assertResp({"type": "DIRECT", "payload":
                                "Killed\n"})
@@ -268,7 +225,7 @@ class Test(unittest.IsolatedAsyncioTestCase):
 
         await asyncio.sleep(1)
         await self.send({"type": "INPUT", "payload": "cat\n"})
-        await asyncio.sleep(0.5)
+        await self.wait_ready()
         await self.send({"type": "INPUT", "payload": "hello world\n"})
         await self.assertResp({"type": "DIRECT",
                                "payload": "hello world\nhello world\n"})